@@ -3,22 +3,41 @@ import argparse
 import requests
 import configparser
 from xml.etree import ElementTree as ET
-import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import logging.config
 import datetime
 import json
 import os
-import sql_nerc
-import configparser as ConfigParser
+import time
+import zlib
+import profiling
+from profiling import stage
 
+# pandas and sql_nerc (pandas, SQLAlchemy, psycopg2) are imported inside the functions using them,
+# so that a --check run finding all collections up-to-date does not load them
 
 # from requests.adapters import HTTPAdapter
 
-def read_xml(terminology):
+# HTTP session is kept between requests (and between polling cycles in daemon mode)
+http_session = requests.Session()
+# parsed config files, keyed by file name
+config_parsers = dict()
+# semantic uri's of the collections (subroot terms), keyed by collection uri
+collection_semantic_uris = dict()
+# [ETag, Last-Modified] of the HEAD response read_xml got for a collection, keyed by collection name
+collection_http_headers = dict()
+# ETag and Last-Modified headers of the last imported version of every collection
+http_headers_file = os.path.join('downloads', 'http_headers.json')
+# dc:date high-water marks and times of the last full harvest of every collection (delta harvest)
+watermarks_file = os.path.join('downloads', 'watermarks.json')
+
+
+def read_xml(terminology, head=None):
     '''
     can read from local xml file or webpage
     IN: xml from local file or webpage
+        head - HEAD response of the collection if it was already requested (daemon mode)
     OUT: ET root object
     '''
     url = terminology['uri']
@@ -26,7 +45,9 @@ def read_xml(terminology):
     url = url + uri_postfix
     collection_name = terminology['collection_name']
     try:
-        head = requests.head(url)
+        if head is None:
+            head = http_session.head(url)
+        collection_http_headers[collection_name] = [head.headers.get('ETag'), head.headers.get('Last-Modified')]
         if head.headers['Content-Type'].startswith('application/rdf+xml'):
             filename = collection_name + '.xml'
             local_folder = '/downloads/'
@@ -50,7 +71,7 @@ def read_xml(terminology):
                         return None
                 else:
                     # download the file
-                    req_main = requests.get(url)
+                    req_main = http_session.get(url)
                     with open(file_abs_path, 'wb') as f:
                         f.write(req_main.content)
                     # write down the corresponding ETag of a collection into .ini file
@@ -61,7 +82,7 @@ def read_xml(terminology):
         elif head.headers['Content-Type'].startswith('text/xml'):
             # read xml response of NERC webpage
             try:
-                req_main = requests.get(url, timeout=30)
+                req_main = http_session.get(url, timeout=30)
                 # ses = requests.Session()
                 # ses.mount('http://', HTTPAdapter(max_retries=3))
                 # req_main= ses.get(url)
@@ -89,28 +110,36 @@ def read_xml(terminology):
     return root_main
 
 
-def xml_parser(root_main, terminologies_left, relation_types, semantic_uri):
+def xml_parser(root_main, terminologies_left, relation_types, semantic_uri, watermark=None):
     """
     Takes root(ET) of a Collection e.g. 'http://vocab.nerc.ac.uk/collection/L05/current/accepted/'
     Returns pandas DataFrame with harvested fields (e.g.semantic_uri,name,etc.) for every member of the collection
+    watermark - if given (delta harvest), members with dc:date at or below it are dropped
     """
+    import pandas as pd
+
     data = []
     members = root_main.findall('./')
+    if watermark is not None:
+        watermark = pd.Timestamp(watermark)
 
     for member in members:
         if(list(member.attrib.values())[0]).casefold() == 'http://vocab.nerc.ac.uk/collection/L05/current/'.casefold()\
                 or (list(member.attrib.values())[0]).casefold() == 'http://vocab.nerc.ac.uk/collection/L22/current/'.casefold():
             continue
 
+        date = member.find('.' + dc + 'date').text  # authoredOn
+        if watermark is not None and pd.Timestamp(date) <= watermark:
+            continue
         D = dict()
-        D['datetime_last_harvest'] = member.find('.' + dc + 'date').text  # authoredOn
+        D['datetime_last_harvest'] = date
         D['semantic_uri'] = str(member.find('.' + dc + 'identifier').text)
         D['name'] = member.find('.' + skos + 'prefLabel').text
         D['description'] = member.find('.' + skos + 'definition').text
         D['uri'] = list(member.attrib.values())[0]
         D['deprecated'] = member.find('.' + owl + 'deprecated').text
-        D['id_term_status'] = int(np.where(D['deprecated'] == 'false', id_term_status_accepted,
-                                           id_term_status_not_accepted))  # important to have int intead of ndarray
+        D['id_term_status'] = id_term_status_accepted if D['deprecated'] == 'false' \
+            else id_term_status_not_accepted
         ''' RELATED TERMS'''
         related_total = list()
         related_uri_list = list()
@@ -169,16 +198,30 @@ def xml_parser(root_main, terminologies_left, relation_types, semantic_uri):
         D['subroot_semantic_uri'] = semantic_uri
 
         data.append(D)
-    df = pd.DataFrame(data)
+    # columns are given, so that the DataFrame is complete also if all members were dropped
+    df = pd.DataFrame(data, columns=['datetime_last_harvest', 'semantic_uri', 'name', 'description', 'uri',
+                                     'deprecated', 'id_term_status', 'related_uri', 'id_relation_type',
+                                     'subroot_semantic_uri'])
     df['datetime_last_harvest'] = pd.to_datetime(df['datetime_last_harvest'])  # convert to TimeStamp
     del df['deprecated']  # deleting not up to date entries
 
     return df
 
 
+def get_config_parser(config_fname):
+    """
+    Returns ConfigParser of a config file.
+    The file is read only once, later calls return the already parsed object
+    """
+    if config_fname not in config_parsers:
+        configParser = configparser.ConfigParser()
+        configParser.read(config_fname)
+        config_parsers[config_fname] = configParser
+    return config_parsers[config_fname]
+
+
 def read_config_uriPostfix(config_fname):
-    configParser = configparser.ConfigParser()
-    configParser.read(config_fname)
+    configParser = get_config_parser(config_fname)
     uri_postfix = configParser.get('INPUT', 'uri_postfix')
     return uri_postfix
 
@@ -190,8 +233,7 @@ def read_config_ETag(config_fname, coll_name):
     If NoNe is returned - the value of ETag was not read properly or
     ETag of a collection do not exist in .ini file
     """
-    configParser = configparser.ConfigParser()
-    configParser.read(config_fname)
+    configParser = get_config_parser(config_fname)
     http_headers = configParser.get('INPUT', 'http_headers_ETag')
     ETag_from_config = None
     if http_headers:
@@ -233,6 +275,7 @@ def add_config_ETag(config_fname, coll_name, header_ETag):
     configParser.set('INPUT', 'http_headers_ETag', content)
     with open(config_fname, 'w') as file:
         configParser.write(file)
+    config_parsers[config_fname] = configParser
 
 
 ## functions for creation of DB connection ##
@@ -245,8 +288,7 @@ def get_config_params():
                         credentials for the PostgreSQL database
       terminologies: JSON string conatining parameteres of terminologies
       """
-    configParser = configparser.ConfigParser()
-    configParser.read(config_file_name)
+    configParser = get_config_parser(config_file_name)
     # READING INI FILE
     # db params
     db_params = dict()
@@ -261,117 +303,678 @@ def get_config_params():
     return db_params, terminologies_params_parsed
 
 
-def main():
+def setup(config_fname):
+    """
+    Reads INPUT parameters of the config file into the module globals and configures logging.
+    Also the initializer of the worker processes of the sharded import
+    """
+    global config_file_name
+    global has_broader_term_pk
+    global is_related_to_pk
+    global id_term_status_accepted
+    global id_term_status_not_accepted
+    global id_user_created_updated
+    global id_term_category
+    global logger
+    config_file_name = config_fname
+    config = get_config_parser(config_file_name)
+    log_config_file = config['INPUT']['log_config_file']
+    has_broader_term_pk = int(config['INPUT']['has_broader_term_pk'])
+    is_related_to_pk = int(config['INPUT']['is_related_to_pk'])
+    id_term_status_accepted = int(config['INPUT']['id_term_status_accepted'])
+    id_term_status_not_accepted = int(config['INPUT']['id_term_status_not_accepted'])
+    id_user_created_updated = int(config['INPUT']['id_user_created_updated'])
+    id_term_category = int(config['INPUT']['id_term_category'])
+
+    logging.config.fileConfig(log_config_file)
+    logger = logging.getLogger(__name__)
+
+
+def get_write_strategy():
+    """
+    Creates sql_nerc.WriteStrategy from DB_WRITE section of the config file
+    (defaults of WriteStrategy are used for missing entries)
+    """
+    import sql_nerc
+
+    configParser = get_config_parser(config_file_name)
+    return sql_nerc.WriteStrategy(
+        page_size=configParser.getint('DB_WRITE', 'page_size', fallback=1000),
+        min_page_size=configParser.getint('DB_WRITE', 'min_page_size', fallback=100),
+        max_page_size=configParser.getint('DB_WRITE', 'max_page_size', fallback=10000),
+        target_latency=configParser.getfloat('DB_WRITE', 'target_latency', fallback=1.0),
+        max_retries=configParser.getint('DB_WRITE', 'max_retries', fallback=3),
+        single_transaction=configParser.getboolean('DB_WRITE', 'single_transaction', fallback=False))
+
+
+def get_collection_semantic_uri(uri, sqlExec):
+    """
+    semantic uri of a collection e.g. L05 - SDN:L05,
+    queried once per collection and kept in collection_semantic_uris
+    """
+    if uri not in collection_semantic_uris:
+        collection_semantic_uris[uri] = sqlExec.semantic_uri_from_uri(uri)
+    return collection_semantic_uris[uri]
+
+
+def harvest_terminology(terminology, terminologies_left, sqlExec, watermark=None, head=None):
+    """
+    Reads and parses xml of a single terminology(collection)
+    Returns pandas DataFrame of its terms or None if the collection was not read properly
+    watermark - dc:date of the delta harvest (see xml_parser)
+    head - HEAD response of the collection (see read_xml)
+    """
+    with stage('read_xml'):
+        root_main = read_xml(terminology, head=head)
+    # if root_main returned None (not read properly)
+    # skip terminology
+    if not root_main:
+        logger.warning("Collection {} skipped, since not read properly".format(terminology['collection_name']))
+        return None
+    # semantic uri is used in xml_parser,get_related_semantic_uri
+    semantic_uri = get_collection_semantic_uri(terminology['uri'], sqlExec)
+    with stage('xml_parser'):
+        df = xml_parser(root_main, terminologies_left, terminology['relation_types'], semantic_uri,
+                        watermark=watermark)
+    # lets assign the id_terminology (e.g. 21 or 22) chosen in .ini file for every terminology
+    df = df.assign(id_terminology=terminology['id_terminology'])
+    logger.info('TERMS SIZE: %s %s %s', str(terminology['collection_name']), ' ', str(len(df)))
+    return df
+
+
+def concat_terminologies(df_list):
+    """
+    Concatenates DataFrames of the harvested collections into df_from_nerc
+    """
+    import pandas as pd
+
+    df_from_nerc = pd.concat(df_list, ignore_index=True)
+    df_from_nerc['id_terminology'] = df_from_nerc['id_terminology'].astype(int)  # change from str to int32
+    df_from_nerc['id_term_status'] = df_from_nerc['id_term_status'].astype(int)  # change from int64 to int32
+    df_from_nerc['name'] = df_from_nerc['name'].astype('str')
+    logger.debug('TOTAL RECORDS %s:', df_from_nerc.shape)
+    return df_from_nerc
+
+
+def read_term_snapshot(sqlExec, used_id_terms_unique, semantic_uris=None, columns='*', uris=None):
+    """
+    Reads the 'term' table from pangaea_db database
+    only the terms of the terminologies (id_terminology) from .ini file are read
+    semantic_uris, uris - if any of them is given, only the terms with these semantic_uri's or uri's are read
+    """
+    sql_command = 'SELECT {} FROM public.term \
+    WHERE id_terminology in ({})' \
+        .format(columns, ",".join([str(_) for _ in used_id_terms_unique]))
+    # took care of the fact that there are different id terminologies e.g. 21 or 22
+    conditions = list()
+    params = dict()
+    if semantic_uris is not None:
+        conditions.append('semantic_uri = ANY(%(semantic_uris)s)')
+        params['semantic_uris'] = list(semantic_uris)
+    if uris is not None:
+        conditions.append('uri = ANY(%(uris)s)')
+        params['uris'] = list(uris)
+    if conditions:
+        sql_command += ' AND ({})'.format(' OR '.join(conditions))
+    else:
+        params = None
+    with stage('dataframe_from_database'):
+        return sqlExec.dataframe_from_database(sql_command, params=params)
+
+
+def import_terms(df_from_nerc, df_from_pangea, sqlExec, DFManipulator):
+    """
+    Inserts new and updates outdated terms of df_from_nerc in public.term
+    Returns False if any of the statements was rolled back
+    """
+    success = True
+    with stage('dataframe_difference'):
+        df_insert, df_update = DFManipulator.dataframe_difference(df_from_nerc, df_from_pangea)
+    # df_insert/df_update.shape=(n,7)!
+    # df_insert,df_update can be None if df_from_nerc or df_from_pangea are empty
+
+    ''' execute INSERT statement if df_insert is not empty'''
+    if df_insert is not None:
+        # id_term_new - id_term's allocated by the parent process in the sharded import
+        id_terms = list(df_insert['id_term_new']) if 'id_term_new' in df_insert else None
+        with stage('df_shaper'):
+            df_insert_shaped = DFManipulator.df_shaper(df_insert, id_term_category=id_term_category,
+                                                       id_user_created=id_user_created_updated,
+                                                       id_user_updated=id_user_created_updated,
+                                                       id_terms=id_terms)  # df_ins.shape=(n,17) ready to insert into SQL DB
+        with stage('batch_insert_new_terms'):
+            success = sqlExec.batch_insert_new_terms(table='term', df=df_insert_shaped) and success
+    else:
+        logger.debug('Inserting new NERC TERMS : SKIPPED')
+
+    ''' execute UPDATE statement if df_update is not empty'''
+    if df_update is not None:
+        with stage('df_shaper'):
+            df_update_shaped = DFManipulator.df_shaper(df_update, df_pang=df_from_pangea,
+                                                       id_term_category=id_term_category,
+                                                       id_user_created=id_user_created_updated,
+                                                       id_user_updated=id_user_created_updated)
+        columns_to_update = ['name', 'datetime_last_harvest', 'description', 'datetime_updated',
+                             'id_term_status', 'uri', 'semantic_uri', 'id_term']
+        with stage('batch_update_terms'):
+            success = sqlExec.batch_update_terms(df=df_update_shaped, columns_to_update=columns_to_update,
+                                                 table='term') and success
+    else:
+        logger.debug('Updating NERC TERMS : SKIPPED')
+    return success
+
+
+def import_relations(df_from_nerc, df_pangaea_for_relation, sqlExec, DFManipulator, df_lookup=None):
+    """
+    Inserts/updates term_relation table
+    df_pangaea_for_relation - current version of pangaea_db.term table (read after insertion and update of terms)
+    df_lookup - terms the related uri's are resolved with besides df_from_nerc (delta harvest, daemon mode)
+    Returns False if relations were not written
+    """
+    if df_pangaea_for_relation is not None:
+        # df_from_nerc contaions all the entries from all collections that we read from xml
+        # find the related semantic uri from related uri
+        with stage('get_related_semantic_uri'):
+            df_related = DFManipulator.get_related_semantic_uri(df_from_nerc, has_broader_term_pk,
+                                                                df_lookup=df_lookup)
+        return write_relations(df_related, df_pangaea_for_relation, sqlExec, DFManipulator)
+    else:
+        logger.debug('Updating relations aborted as insert/update are not successful')
+        return False
+
+
+def write_relations(df_related, df_pangaea_for_relation, sqlExec, DFManipulator):
+    """
+    Writes relations of df_related (result of get_related_semantic_uri) into term_relation table
+    """
+    # take corresponding id_terms from SQL pangaea_db.term table(df_pangaea_for_relation)
+    with stage('get_primary_keys'):
+        df_related_pk = DFManipulator.get_primary_keys(df_related, df_pangaea_for_relation)
+    # call shaper to get df into proper shape
+    with stage('related_df_shaper'):
+        df_related_shaped = DFManipulator.related_df_shaper(df_related_pk, id_user_created_updated)
+    logger.debug('TOTAL RELATIONS %s:', df_related_shaped.shape)
+    # call batch import
+    with stage('insert_update_relations'):
+        return sqlExec.insert_update_relations(table='term_relation', df=df_related_shaped)
+
+
+## functions for delta harvest ##
+def read_watermarks():
+    """
+    reads watermarks_file (JSON)
+    returns dictionary collection_name -> {"watermark": dc:date, "full_harvest": time of the last full harvest}
+    """
+    try:
+        with open(watermarks_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+        logger.debug(e)
+        return dict()
+
+
+def add_watermarks(imported_watermarks):
+    """
+    First reads existing entries then
+    adds the watermarks of the imported collections and writes them into watermarks_file
+    """
+    watermarks = read_watermarks()
+    watermarks.update(imported_watermarks)
+    with open(watermarks_file, 'w') as f:
+        json.dump(watermarks, f, indent=2)
+
+
+def get_collection_watermark(watermarks, collection_name, full_reconcile_days):
+    """
+    Returns dc:date watermark of a collection for the delta harvest or
+    None if the collection is harvested fully (no watermark yet or the periodic full reconcile is due)
+    """
+    entry = watermarks.get(collection_name)
+    if not entry or not entry.get('watermark'):
+        return None
+    last_full_harvest = datetime.datetime.fromisoformat(entry['full_harvest'])
+    if datetime.datetime.now() - last_full_harvest >= datetime.timedelta(days=full_reconcile_days):
+        logger.info('Full reconcile of collection {}'.format(collection_name))
+        return None
+    return entry['watermark']
+
+
+def next_watermark(df, watermark, entry):
+    """
+    watermarks_file entry of a collection after import of its harvested terms (df)
+    watermark - watermark df was harvested with (None for full harvest)
+    """
+    entry = dict(entry or {})
+    if df['datetime_last_harvest'].notna().any():
+        entry['watermark'] = df['datetime_last_harvest'].max().isoformat()
+    if watermark is None:
+        entry['full_harvest'] = datetime.datetime.now().isoformat()
+    return entry
+
+
+def import_delta(df_from_nerc, used_id_terms_unique, sqlExec, DFManipulator):
+    """
+    Imports terms changed since the watermarks (df_from_nerc harvested with watermarks),
+    public.term is read only for these terms and their relation endpoints
+    Returns (terms_imported, relations_imported)
+    """
+    changed_s_uris = set(df_from_nerc['semantic_uri'])
+    df_from_pangea = read_term_snapshot(sqlExec, used_id_terms_unique, semantic_uris=changed_s_uris)
+    terms_imported = import_terms(df_from_nerc, df_from_pangea, sqlExec, DFManipulator)
+
+    ''' TERM_RELATION TABLE'''
+    # related terms not harvested (unchanged) are resolved by their uri in public.term,
+    # subroot semantic uri's are needed for the 'orphan' terms
+    related_uris = set()
+    related_uris.update(*df_from_nerc['related_uri'])
+    s_uris = changed_s_uris | set(df_from_nerc['subroot_semantic_uri'])
+    df_pangaea_for_relation = read_term_snapshot(sqlExec, used_id_terms_unique, semantic_uris=s_uris,
+                                                 uris=related_uris)
+    relations_imported = import_relations(df_from_nerc, df_pangaea_for_relation, sqlExec, DFManipulator,
+                                          df_lookup=df_pangaea_for_relation)
+    return terms_imported, relations_imported
+
+
+## functions for sharded import ##
+def shard_key(semantic_uri, workers):
+    """
+    stable (not randomized per process like hash()) shard number of a semantic_uri
+    """
+    return zlib.crc32(semantic_uri.encode('utf-8')) % workers
+
+
+def shard_terms(df_from_nerc, workers, shard_by):
+    """
+    Partitions df_from_nerc into shards, either one shard per terminology(collection)
+    or <workers> shards by semantic_uri hash
+    """
+    if shard_by == 'terminology':
+        keys = df_from_nerc['subroot_semantic_uri']
+    else:
+        keys = df_from_nerc['semantic_uri'].apply(shard_key, workers=workers)
+    return [df_shard for _, df_shard in df_from_nerc.groupby(keys, sort=False)]
+
+
+def allocate_id_terms(df_from_nerc, sqlExec, used_id_terms_unique):
+    """
+    Allocates id_term's for the new terms in one place, so that the shards do not collide.
+    The new terms get the same id_term's as in the single process import (MAX(id_term)+1,... in order of df_from_nerc)
+    id_term_new is meaningful only for the terms not in the database
+    """
+    df_s_uris = read_term_snapshot(sqlExec, used_id_terms_unique, columns='semantic_uri')
+    is_new = ~df_from_nerc['semantic_uri'].isin(df_s_uris['semantic_uri'])
+    max_id_term = sqlExec.get_max_id_term()
+    return df_from_nerc.assign(id_term_new=max_id_term + is_new.astype(int).cumsum())
+
+
+def import_terms_shard(df_shard, used_id_terms_unique, db_credentials):
+    """
+    Worker process: diff, shape and write a shard of terms with its own connection and transaction
+    """
+    import sql_nerc
+
+    write_strategy = get_write_strategy()
+    sqlExec = sql_nerc.SQLExecutor(db_credentials, write_strategy)
+    DFManipulator = sql_nerc.DframeManipulator(db_credentials, write_strategy)
+    df_from_pangea = read_term_snapshot(sqlExec, used_id_terms_unique, semantic_uris=df_shard['semantic_uri'])
+    terms_imported = import_terms(df_shard, df_from_pangea, sqlExec, DFManipulator)
+    return write_strategy.commit() and terms_imported
+
+
+def write_relations_shard(df_related_shard, df_pangaea_for_relation, db_credentials):
+    """
+    Worker process: write a shard of relations with its own connection and transaction
+    """
+    import sql_nerc
+
+    write_strategy = get_write_strategy()
+    sqlExec = sql_nerc.SQLExecutor(db_credentials, write_strategy)
+    DFManipulator = sql_nerc.DframeManipulator(db_credentials, write_strategy)
+    relations_imported = write_relations(df_related_shard, df_pangaea_for_relation, sqlExec, DFManipulator)
+    return write_strategy.commit() and relations_imported
+
+
+def import_sharded(df_from_nerc, used_id_terms_unique, db_credentials, sqlExec, DFManipulator, workers, shard_by):
+    """
+    Imports terms shard by shard in <workers> processes,
+    relations are written once all shards' terms exist (sharded by semantic_uri hash of the term)
+    Returns (terms_imported, relations_imported)
+    """
+    df_from_nerc = allocate_id_terms(df_from_nerc, sqlExec, used_id_terms_unique)
+    shards = shard_terms(df_from_nerc, workers, shard_by)
+    logger.debug('Importing %s shards of terms in %s processes', len(shards), workers)
+    # spawn - connection pools of the parent process are not inherited
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=setup, initargs=(config_file_name,)) as executor:
+        futures = [executor.submit(import_terms_shard, df_shard, used_id_terms_unique, db_credentials)
+                   for df_shard in shards]
+        with stage('import_terms_shards'):
+            terms_imported = all([future.result() for future in futures])
+
+        ''' TERM_RELATION TABLE'''
+        df_pangaea_for_relation = read_term_snapshot(sqlExec, used_id_terms_unique)
+        # related uri's are resolved against all collections, so this step is done for the whole df_from_nerc
+        with stage('get_related_semantic_uri'):
+            df_related = DFManipulator.get_related_semantic_uri(df_from_nerc, has_broader_term_pk)
+        keys = df_related['semantic_uri'].apply(shard_key, workers=workers)
+        futures = list()
+        for _, df_related_shard in df_related.groupby(keys, sort=False):
+            # pass only the part of public.term the shard refers to
+            s_uris = set(df_related_shard['semantic_uri'])
+            s_uris.update(*df_related_shard['related_s_uri'])
+            df_pang_shard = df_pangaea_for_relation[df_pangaea_for_relation['semantic_uri'].isin(s_uris)]
+            futures.append(executor.submit(write_relations_shard, df_related_shard, df_pang_shard, db_credentials))
+        with stage('write_relations_shards'):
+            relations_imported = all([future.result() for future in futures])
+    return terms_imported, relations_imported
+
+
+def main(workers=1, shard_by='hash', delta=False):
+    """
+    workers - if more than 1, terms are imported in worker processes (see import_sharded)
+    shard_by - 'hash' (semantic_uri hash) or 'terminology'
+    delta - harvest only the concepts changed since the dc:date watermark of their collection (see import_delta)
+    """
     global terminologies_names  # used in xml_parser
+    import sql_nerc
 
     terminologies_done = list()
     # get db and terminologies parameters from config file
     db_credentials, terminologies = get_config_params()
 
+    # writers of both objects share the write strategy (and its transaction in single transaction mode)
+    write_strategy = get_write_strategy()
     # create SQLexecutor object
-    sqlExec = sql_nerc.SQLExecutor(db_credentials)
+    sqlExec = sql_nerc.SQLExecutor(db_credentials, write_strategy)
     # create DataframeManipulator object
-    DFManipulator = sql_nerc.DframeManipulator(db_credentials)
+    DFManipulator = sql_nerc.DframeManipulator(db_credentials, write_strategy)
 
     terminologies_names = [collection['collection_name'] for collection in
                            terminologies]  # for xml_parser, ['L05', 'L22', 'P01']
     id_terminologies_SQL = sqlExec.get_id_terminologies()
     df_list = []
+    imported_http_headers = dict()
+    watermarks = read_watermarks()
+    imported_watermarks = dict()
+    full_reconcile_days = get_config_parser(config_file_name).getint('DELTA', 'full_reconcile_days', fallback=7)
     # terminology - dictionary containing terminology name, uri and relation_type
     for terminology in terminologies:
         if int(terminology['id_terminology']) in id_terminologies_SQL:
             terminologies_left = [x for x in terminologies_names if x not in terminologies_done]
-            root_main = read_xml(terminology)
-            # if root_main returned None (not read properly)
-            # skip terminology
-            # if not root_main:
-            # logger.debug("Collection {} skipped, since not read properly".format(terminology['collection_name']))
-            # continue
-            if root_main:
-                # semantic uri of a collection e.g. L05 - SDN:L05,
-                # semantic uri is used in xml_parser,get_related_semantic_uri
-                semantic_uri = sqlExec.semantic_uri_from_uri(terminology['uri'])
-                df = xml_parser(root_main, terminologies_left, terminology['relation_types'], semantic_uri)
-                # lets assign the id_terminology (e.g. 21 or 22) chosen in .ini file for every terminology
-                df = df.assign(id_terminology=terminology['id_terminology'])
-                logger.info('TERMS SIZE: %s %s %s', str(terminology['collection_name']), ' ', str(len(df)))
+            watermark = None
+            if delta:
+                watermark = get_collection_watermark(watermarks, terminology['collection_name'], full_reconcile_days)
+            df = harvest_terminology(terminology, terminologies_left, sqlExec, watermark=watermark)
+            if df is not None:
                 df_list.append(df)
+                # headers of the HEAD request read_xml sent before download,
+                # a change during the import is caught by the next --check
+                imported_http_headers[terminology['collection_name']] = \
+                    collection_http_headers[terminology['collection_name']]
+                # every successful run moves the watermarks, a run without delta is a full harvest
+                imported_watermarks[terminology['collection_name']] = next_watermark(
+                    df, watermark, watermarks.get(terminology['collection_name']))
                 del df  # to free memory
                 terminologies_done.append(terminology['collection_name'])
-            else:
-                logger.warning("Collection {} skipped, since not read properly".format(terminology['collection_name']))
         else:
             logger.debug('No corresponding id_terminology in SQL database,'
                          ' terminology {} skipped'.format(terminology['collection_name']))
+            # marked as skipped (not imported), so that --check does not report it as changed on every run
+            imported_http_headers[terminology['collection_name']] = {
+                'skipped': True, 'headers': get_collection_validators(terminology)}
 
-    if df_list:
-        df_from_nerc = pd.concat(df_list, ignore_index=True)
-        df_from_nerc['id_terminology'] = df_from_nerc['id_terminology'].astype(int)  # change from str to int32
-        df_from_nerc['id_term_status'] = df_from_nerc['id_term_status'].astype(int)  # change from int64 to int32
+    if not df_list:
+        logger.debug('Inserting/updating NERC TERMS : SKIPPED')
+        add_http_headers(imported_http_headers)
+        return
 
-        df_from_nerc['name'] = df_from_nerc['name'].astype('str')
-        col_one_list = df_from_nerc['name'].tolist()
-        # print ('LONGEST :', max(col_one_list, key=len))
-        # print(len(df_from_nerc[df_from_nerc['name'].apply(lambda x: len(x) >= 255)]))
-        logger.debug('TOTAL RECORDS %s:', df_from_nerc.shape)
+    df_from_nerc = concat_terminologies(df_list)
+    del df_list  # to free memory
+    used_id_terms_unique = set([terminology['id_terminology'] for terminology in terminologies])
 
-        del df_list  # to free memory
-        # reading the 'term' table from  pangaea_db database
-        used_id_terms = [terminology['id_terminology'] for terminology in terminologies]
-        used_id_terms_unique = set(used_id_terms)
+    if len(df_from_nerc) == 0:
+        logger.debug('No changed NERC TERMS since the watermarks')
+        terms_imported, relations_imported = True, True
+    elif delta:
+        if workers > 1:
+            logger.debug('Delta harvest is imported in a single process')
+        terms_imported, relations_imported = import_delta(df_from_nerc, used_id_terms_unique, sqlExec, DFManipulator)
+    elif workers > 1:
+        if write_strategy.single_transaction:
+            logger.warning('single_transaction does not apply to the sharded import,'
+                           ' every shard of terms and relations is committed in its own transaction')
+        terms_imported, relations_imported = import_sharded(df_from_nerc, used_id_terms_unique, db_credentials,
+                                                            sqlExec, DFManipulator, workers, shard_by)
+    else:
+        df_from_pangea = read_term_snapshot(sqlExec, used_id_terms_unique)
+        terms_imported = import_terms(df_from_nerc, df_from_pangea, sqlExec, DFManipulator)
 
-        sql_command = 'SELECT * FROM public.term \
-        WHERE id_terminology in ({})' \
-            .format(",".join([str(_) for _ in used_id_terms_unique]))
-        # took care of the fact that there are different id terminologies e.g. 21 or 22
+        ''' TERM_RELATION TABLE'''
+        # need the current version of pangaea_db.term table
+        # because it could change after insertion and update terms
+        df_pangaea_for_relation = read_term_snapshot(sqlExec, used_id_terms_unique)
+        relations_imported = import_relations(df_from_nerc, df_pangaea_for_relation, sqlExec, DFManipulator)
+    if write_strategy.commit() and terms_imported and relations_imported:
+        add_http_headers(imported_http_headers)
+        add_watermarks(imported_watermarks)
 
-        df_from_pangea = sqlExec.dataframe_from_database(sql_command)
-        df_insert, df_update = DFManipulator.dataframe_difference(df_from_nerc, df_from_pangea)
-        # df_insert/df_update.shape=(n,7)!
-        # df_insert,df_update can be None if df_from_nerc or df_from_pangea are empty
 
-        ''' execute INSERT statement if df_insert is not empty'''
-        if df_insert is not None:
-            df_insert_shaped = DFManipulator.df_shaper(df_insert, id_term_category=id_term_category,
-                                                       id_user_created=id_user_created_updated,
-                                                       id_user_updated=id_user_created_updated)  # df_ins.shape=(n,17) ready to insert into SQL DB
-            sqlExec.batch_insert_new_terms(table='term', df=df_insert_shaped)
-    else:
-        logger.debug('Inserting new NERC TERMS : SKIPPED')
+## functions for checking freshness of the collections and daemon mode ##
+def select_changed_terms(df_from_nerc, df_index):
+    """
+    Returns the terms of df_from_nerc which are not in df_index (semantic_uri, id_term, datetime_last_harvest
+    of public.term) or have a newer datetime_last_harvest there
+    """
+    last_harvest = df_index.drop_duplicates('semantic_uri').set_index('semantic_uri')['datetime_last_harvest']
+    last_harvest = df_from_nerc['semantic_uri'].map(last_harvest)
+    return df_from_nerc[last_harvest.isna() | (df_from_nerc['datetime_last_harvest'] > last_harvest)].copy()
 
-    ''' execute UPDATE statement if df_update is not empty'''
-    if df_update is not None:
-        # df_update_shaped = DFManipulator.df_shaper(df_update,df_pang=df_from_pangea)  # add default columns to the table (prepare to be updated to PANGAEA DB)
-        df_update_shaped = DFManipulator.df_shaper(df_update, df_pang=df_from_pangea, id_term_category=id_term_category,
-                                                   id_user_created=id_user_created_updated,
-                                                   id_user_updated=id_user_created_updated)
-        columns_to_update = ['name', 'datetime_last_harvest', 'description', 'datetime_updated',
-                             'id_term_status', 'uri', 'semantic_uri', 'id_term']
-        sqlExec.batch_update_terms(df=df_update_shaped, columns_to_update=columns_to_update,
-                                   table='term')
-    else:
-        logger.debug('Updating NERC TERMS : SKIPPED')
 
-    ''' TERM_RELATION TABLE'''
-    sql_command = 'SELECT * FROM public.term \
-      WHERE id_terminology in ({})' \
-    .format(",".join([str(_) for _ in used_id_terms_unique]))
-    # need the current version of pangaea_db.term table
-    # because it could change after insertion and update terms
-    df_pangaea_for_relation = sqlExec.dataframe_from_database(sql_command)
-    if df_pangaea_for_relation is not None:
-       # df_from_nerc contaions all the entries from all collections that we read from xml
-       # find the related semantic uri from related uri
-       df_related = DFManipulator.get_related_semantic_uri(df_from_nerc,has_broader_term_pk)
-       # take corresponding id_terms from SQL pangaea_db.term table(df_pangaea_for_relation)
-       df_related_pk = DFManipulator.get_primary_keys(df_related, df_pangaea_for_relation)
-       # call shaper to get df into proper shape
-       df_related_shaped = DFManipulator.related_df_shaper(df_related_pk, id_user_created_updated)
-       logger.debug('TOTAL RELATIONS %s:', df_related_shaped.shape)
-       # call batch import
-       sqlExec.insert_update_relations(table='term_relation', df=df_related_shaped)
-    else:
-       logger.debug('Updating relations aborted as insert/update are not successful')
+def head_collection(terminology):
+    """
+    Sends HEAD request for a collection
+    Returns the response or None if the request failed
+    """
+    url = terminology['uri'] + read_config_uriPostfix(config_file_name)
+    try:
+        head = http_session.head(url, timeout=30)
+        head.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.debug(e)
+        return None
+    return head
+
+
+def get_collection_validators(terminology):
+    """
+    Returns [ETag, Last-Modified] headers of a collection or None if the HEAD request failed
+    """
+    head = head_collection(terminology)
+    if head is None:
+        return None
+    return [head.headers.get('ETag'), head.headers.get('Last-Modified')]
+
+
+def validators_match(collection_validators, imported_validators):
+    """
+    True if the collection is known to be unchanged since the import
+    (collections without ETag and Last-Modified headers are always treated as changed)
+    """
+    return collection_validators is not None and collection_validators != [None, None] \
+        and collection_validators == imported_validators
+
+
+def read_http_headers():
+    """
+    reads http_headers_file (JSON)
+    returns dictionary collection_name -> [ETag, Last-Modified] of the last imported version of the collection
+    or {"skipped": true, "headers": [ETag, Last-Modified]} if the collection was skipped by the last import
+    (no id_terminology in the database)
+    """
+    try:
+        with open(http_headers_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+        logger.debug(e)
+        return dict()
+
+
+def add_http_headers(imported_http_headers):
+    """
+    First reads existing entries then
+    adds the headers of the imported collections and writes them into http_headers_file
+    """
+    http_headers = read_http_headers()
+    http_headers.update(imported_http_headers)
+    with open(http_headers_file, 'w') as f:
+        json.dump(http_headers, f, indent=2)
+
+
+def collections_changed(terminologies):
+    """
+    Checks ETag/Last-Modified of every collection (HEAD requests are sent in parallel)
+    Returns True if any of the collections changed since its last import or could not be checked
+    Collections skipped by the last import are not checked, they are imported by the next run without --check
+    """
+    http_headers = read_http_headers()
+    skipped = [terminology for terminology in terminologies
+               if isinstance(http_headers.get(terminology['collection_name']), dict)
+               and http_headers[terminology['collection_name']].get('skipped')]
+    for terminology in skipped:
+        logger.debug('Collection {} skipped by the last import, not checked'.format(terminology['collection_name']))
+    terminologies = [terminology for terminology in terminologies if terminology not in skipped]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        all_validators = list(executor.map(get_collection_validators, terminologies))
+    changed = False
+    for terminology, collection_validators in zip(terminologies, all_validators):
+        if not validators_match(collection_validators, http_headers.get(terminology['collection_name'])):
+            logger.info('Collection {} changed since the last import'.format(terminology['collection_name']))
+            changed = True
+    return changed
+
+
+def run_daemon():
+    """
+    Polls every terminology on its own interval ("poll_interval" in seconds in the terminology JSON,
+    otherwise poll_interval of DAEMON section) and imports only the collections which changed since the last cycle.
+    HTTP session, DB connection pool, parsed config, harvested collections
+    and an index of public.term (semantic_uri, id_term, datetime_last_harvest) are kept between the cycles.
+    Only the changed terms are written, the index is updated by reading back just these terms.
+    Every full_reconcile_days (DELTA section) the relations of all harvested terms are written
+    and the index is read again, to catch relations to terms written later (e.g. skipped before).
+    """
+    global terminologies_names  # used in xml_parser
+    import pandas as pd
+    import sql_nerc
+
+    db_credentials, terminologies = get_config_params()
+    default_interval = get_config_parser(config_file_name).getint('DAEMON', 'poll_interval', fallback=900)
+    full_reconcile_interval = 86400 * get_config_parser(config_file_name).getint('DELTA', 'full_reconcile_days',
+                                                                                  fallback=7)
+    # the write strategy keeps its tuned page size between the cycles
+    write_strategy = get_write_strategy()
+    sqlExec = sql_nerc.SQLExecutor(db_credentials, write_strategy)
+    DFManipulator = sql_nerc.DframeManipulator(db_credentials, write_strategy)
+
+    terminologies_names = [collection['collection_name'] for collection in terminologies]
+    used_id_terms_unique = set([terminology['id_terminology'] for terminology in terminologies])
+    id_terminologies_SQL = sqlExec.get_id_terminologies()
+
+    df_collections = dict()  # collection_name -> DataFrame of the last imported version of the collection
+    validators = dict()  # collection_name -> (ETag, Last-Modified) of the last imported version
+    next_poll = {name: 0 for name in terminologies_names}
+    index_columns = 'semantic_uri, id_term, datetime_last_harvest'
+    df_index = None  # index of public.term
+    last_full_reconcile = None  # time of the last full pass of relations, the first one runs after the first import
+
+    while True:
+        now = time.monotonic()
+        changed = list()
+        new_validators = dict()
+        for position, terminology in enumerate(terminologies):
+            name = terminology['collection_name']
+            if next_poll[name] > now:
+                continue
+            next_poll[name] = now + int(terminology.get('poll_interval', default_interval))
+            if int(terminology['id_terminology']) not in id_terminologies_SQL:
+                logger.debug('No corresponding id_terminology in SQL database,'
+                             ' terminology {} skipped'.format(name))
+                continue
+            # the response is passed to read_xml, so that a changed collection is requested only once more
+            head = head_collection(terminology)
+            if head is None:
+                logger.warning("Collection {} skipped, since not read properly".format(name))
+                continue
+            collection_validators = [head.headers.get('ETag'), head.headers.get('Last-Modified')]
+            if name in df_collections and validators_match(collection_validators, validators.get(name)):
+                logger.debug('Collection {} is up-to-date'.format(name))
+                continue
+            # same bidirectional relation rule as in main - relate only to the collections not parsed before
+            terminologies_done = [x for x in terminologies_names[:position] if x in df_collections]
+            terminologies_left = [x for x in terminologies_names if x not in terminologies_done]
+            df = harvest_terminology(terminology, terminologies_left, sqlExec, head=head)
+            if df is not None:
+                df_collections[name] = df
+                new_validators[name] = collection_validators
+                changed.append(name)
+
+        if changed:
+            logger.info('Importing changed collections: %s', ', '.join(changed))
+            try:
+                if df_index is None:
+                    df_index = read_term_snapshot(sqlExec, used_id_terms_unique, columns=index_columns)
+                df_changed = select_changed_terms(concat_terminologies([df_collections[name] for name in changed]),
+                                                  df_index)
+                logger.info('Changed terms: %s', len(df_changed))
+                terms_imported, relations_imported = True, True
+                if len(df_changed) != 0:
+                    terms_imported = import_terms(df_changed, df_index, sqlExec, DFManipulator)
+                    # update the index from the written terms only
+                    changed_s_uris = set(df_changed['semantic_uri'])
+                    df_written = read_term_snapshot(sqlExec, used_id_terms_unique, semantic_uris=changed_s_uris,
+                                                    columns=index_columns)
+                    df_index = pd.concat([df_index[~df_index['semantic_uri'].isin(changed_s_uris)], df_written],
+                                         ignore_index=True)
+                    # relations of the changed terms, related uri's are resolved against all collections
+                    df_lookup = pd.concat([df_collections[name][['uri', 'semantic_uri']]
+                                           for name in terminologies_names if name in df_collections],
+                                          ignore_index=True)
+                    relations_imported = import_relations(df_changed, df_index, sqlExec, DFManipulator,
+                                                          df_lookup=df_lookup)
+                if not (write_strategy.commit() and terms_imported and relations_imported):
+                    raise RuntimeError('statements were rolled back')
+                validators.update(new_validators)
+                add_http_headers(new_validators)
+            except Exception:
+                # keep polling, the collections are imported again in the next cycle
+                logger.exception('Import of collections {} failed'.format(', '.join(changed)))
+                write_strategy.rollback()
+                write_strategy.failed = False
+                df_index = None
+                for name in changed:
+                    del df_collections[name]
+
+        if df_collections and (last_full_reconcile is None
+                               or time.monotonic() - last_full_reconcile >= full_reconcile_interval):
+            logger.info('Full reconcile of relations')
+            try:
+                # the index of the first pass was just read
+                if df_index is None or last_full_reconcile is not None:
+                    df_index = read_term_snapshot(sqlExec, used_id_terms_unique, columns=index_columns)
+                df_all = concat_terminologies([df_collections[name] for name in terminologies_names
+                                               if name in df_collections])
+                relations_imported = import_relations(df_all, df_index, sqlExec, DFManipulator)
+                if not (write_strategy.commit() and relations_imported):
+                    raise RuntimeError('statements were rolled back')
+                last_full_reconcile = time.monotonic()
+            except Exception:
+                # tried again in the next cycle
+                logger.exception('Full reconcile of relations failed')
+                write_strategy.rollback()
+                write_strategy.failed = False
+                df_index = None
+
+        time.sleep(max(0, min(next_poll.values()) - time.monotonic()))
 
 
 if __name__ == '__main__':
@@ -385,31 +988,47 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", action="store", help='specify the path of the config file',
                         dest="config_file", required=True)
-    config = ConfigParser.ConfigParser()
-    global config_file_name
-    global has_broader_term_pk
-    global is_related_to_pk
-    global id_term_status_accepted
-    global id_term_status_not_accepted
-    global id_user_created_updated
-    global id_term_category
-    config_file_name = parser.parse_args().config_file
+    parser.add_argument("--daemon", action="store_true", help='keep running and poll the collections periodically',
+                        dest="daemon")
+    parser.add_argument("--check", action="store_true",
+                        help='check ETag/Last-Modified of the collections first and import only if any of them changed',
+                        dest="check")
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        help='number of worker processes importing the shards of terms', dest="workers")
+    parser.add_argument("--shard-by", action="store", choices=['hash', 'terminology'], default='hash',
+                        help='partition terms by semantic_uri hash or by terminology', dest="shard_by")
+    parser.add_argument("--delta", action="store_true",
+                        help='harvest only the concepts changed since the dc:date watermark of their collection',
+                        dest="delta")
+    parser.add_argument("--profile", action="store", nargs='?', const='cprofile', choices=['cprofile', 'sample'],
+                        help='profile the run, write per-stage profiles and collapsed stacks into logs/',
+                        dest="profile")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help='with --profile, trace allocations of every stage', dest="profile_memory")
+    args = parser.parse_args()
     # config_file_name ='E:/WORK/UNI_BREMEN/nerc-importer/config/import.ini'
-    config.read(config_file_name)
-    log_config_file = config['INPUT']['log_config_file']
-    has_broader_term_pk = int(config['INPUT']['has_broader_term_pk'])
-    is_related_to_pk = int(config['INPUT']['is_related_to_pk'])
-    id_term_status_accepted = int(config['INPUT']['id_term_status_accepted'])
-    id_term_status_not_accepted = int(config['INPUT']['id_term_status_not_accepted'])
-    id_user_created_updated = int(config['INPUT']['id_user_created_updated'])
-    id_term_category = int(config['INPUT']['id_term_category'])
-
-    logging.config.fileConfig(log_config_file)
-    logger = logging.getLogger(__name__)
-    logger.debug("Starting NERC harvester...")
-    a = datetime.datetime.now()
-    main()
-    b = datetime.datetime.now()
-    diff = b - a
-    logger.debug('Total execution time:%s' % diff)
+    setup(args.config_file)
+    if args.profile:
+        profiling.start(mode=args.profile, memory=args.profile_memory)
+    try:
+        if args.daemon:
+            logger.debug("Starting NERC harvester in daemon mode...")
+            try:
+                run_daemon()
+            except KeyboardInterrupt:
+                logger.debug('NERC harvester daemon stopped')
+        elif args.check and not collections_changed(get_config_params()[1]):
+            logger.debug('All collections are up-to-date, import skipped')
+        else:
+            logger.debug("Starting NERC harvester...")
+            a = datetime.datetime.now()
+            main(workers=args.workers, shard_by=args.shard_by, delta=args.delta)
+            b = datetime.datetime.now()
+            diff = b - a
+            logger.debug('Total execution time:%s' % diff)
+    finally:
+        # partial profiles are written also if the run failed
+        if args.profile:
+            for path in profiling.stop():
+                logger.debug('Profile written: %s' % path)
     logger.debug('----------------------------------------')
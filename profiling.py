@@ -0,0 +1,176 @@
+"""
+Profiling of harvester runs (harvester.py --profile)
+
+The import is divided into stages (read_xml, xml_parser, dataframe_difference, batch_insert_new_terms,...)
+marked with the stage() context manager. When profiling is off stage() does nothing.
+Output written into the output folder (logs/), <run> = profile_<date>_<time>:
+    <run>_<stage>.prof       - cProfile statistics of a stage (--profile cprofile), read with pstats/snakeviz
+    <run>_<stage>.collapsed  - sampled stacks of a stage in collapsed format (flamegraph.pl, speedscope)
+    <run>.collapsed          - sampled stacks of the whole run, the root frame is the stage
+    <run>_memory.txt         - allocations per source line of every top-level stage (--profile-memory)
+Worker processes of the sharded import are not profiled.
+"""
+import collections
+import contextlib
+import datetime
+import os
+import sys
+import threading
+
+# Profiler of the current run, None if profiling is off
+active_profiler = None
+
+
+class Profiler(object):
+    """
+    mode - 'cprofile' (deterministic profile of every stage and sampled stacks)
+           or 'sample' (sampled stacks only, lower overhead)
+    memory - trace allocations with tracemalloc
+    interval - sampling interval in seconds
+    """
+
+    def __init__(self, mode='cprofile', memory=False, output_dir='logs', interval=0.005):
+        self.mode = mode
+        self.memory = memory
+        self.output_dir = output_dir
+        self.interval = interval
+        self.run_name = 'profile_' + datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.stages = list()  # stack of the active stages
+        self.profiles = dict()  # stage -> cProfile.Profile
+        self.samples = collections.Counter()  # collapsed stack -> number of samples
+        self.memory_snapshot = None  # tracemalloc snapshot taken when the top-level stage was entered
+        self.allocations = collections.defaultdict(collections.Counter)  # stage -> source line -> size
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        while self.stages:
+            self.exit()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def sample(self):
+        """
+        runs in a separate thread, records the stack of the profiled thread every interval
+        """
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stages = self.stages
+            stack.append(stages[-1] if stages else 'main')
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def enter(self, name):
+        # snapshots are taken only for top-level stages (they are expensive) and
+        # before the stage's profiler is enabled, so that they are not part of the stage's profile
+        if self.memory and not self.stages:
+            import tracemalloc
+            self.memory_snapshot = tracemalloc.take_snapshot()
+        if self.mode == 'cprofile':
+            import cProfile
+            # only one profiler can be active, the outer stage is paused
+            if self.stages:
+                self.profiles[self.stages[-1]].disable()
+            self.profiles.setdefault(name, cProfile.Profile()).enable()
+        self.stages.append(name)
+
+    def exit(self):
+        name = self.stages.pop()
+        if self.mode == 'cprofile':
+            self.profiles[name].disable()
+            if self.stages:
+                self.profiles[self.stages[-1]].enable()
+        if self.memory and not self.stages:
+            import tracemalloc
+            # allocations of tracemalloc and of the profiler itself are left out
+            ignored_files = (tracemalloc.__file__, __file__)
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.compare_to(self.memory_snapshot, 'lineno'):
+                frame = stat.traceback[0]
+                if frame.filename not in ignored_files:
+                    self.allocations[name]['{}:{}'.format(frame.filename, frame.lineno)] += stat.size_diff
+            self.memory_snapshot = None
+
+    def write(self):
+        """
+        writes the profile files into output_dir, returns their paths
+        """
+        import pstats
+
+        paths = list()
+        path_prefix = os.path.join(self.output_dir, self.run_name)
+        for name, profile in self.profiles.items():
+            path = '{}_{}.prof'.format(path_prefix, name)
+            pstats.Stats(profile).dump_stats(path)
+            paths.append(path)
+
+        stacks_by_stage = collections.defaultdict(list)
+        for stack, count in self.samples.items():
+            stacks_by_stage[stack.split(';', 1)[0]].append('{} {}\n'.format(stack, count))
+        with open(path_prefix + '.collapsed', 'w') as f:
+            for lines in stacks_by_stage.values():
+                f.writelines(lines)
+        paths.append(path_prefix + '.collapsed')
+        for name, lines in stacks_by_stage.items():
+            path = '{}_{}.collapsed'.format(path_prefix, name)
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            paths.append(path)
+
+        if self.memory:
+            path = path_prefix + '_memory.txt'
+            with open(path, 'w') as f:
+                for name, allocations in self.allocations.items():
+                    f.write('{} - top allocations (bytes)\n'.format(name))
+                    for line, size in allocations.most_common(30):
+                        f.write('{:>14} {}\n'.format(size, line))
+                    f.write('\n')
+            paths.append(path)
+        return paths
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    marks a stage of the import, does nothing when profiling is off
+    """
+    if active_profiler is None:
+        yield
+        return
+    active_profiler.enter(name)
+    try:
+        yield
+    finally:
+        active_profiler.exit()
+
+
+def start(mode='cprofile', memory=False, output_dir='logs'):
+    global active_profiler
+    active_profiler = Profiler(mode=mode, memory=memory, output_dir=output_dir)
+    active_profiler.start()
+    return active_profiler
+
+
+def stop():
+    """
+    stops profiling and writes the profile files, returns their paths
+    """
+    global active_profiler
+    profiler = active_profiler
+    active_profiler = None
+    profiler.stop()
+    return profiler.write()
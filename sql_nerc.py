@@ -1,16 +1,179 @@
 import pandas as pd
 import numpy as np
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
 from sqlalchemy import create_engine
 import datetime
 import logging
+import time
+
+# SQLalchemy engines (connection pools) shared by all connectors, keyed by database url
+engines = dict()
+
+class WriteStrategy(object):
+    """
+    Defines how SQLExecutor writers send rows to the database:
+    rows are written in pages, the page size is tuned from the measured statement latency
+    (target_latency in seconds, within min_page_size..max_page_size).
+    Every page is written in a savepoint - on a transient error (deadlock, serialization failure,
+    lock timeout) only the page is retried, a page failing on bad data is split until the bad rows
+    are found, these rows are skipped and logged.
+    single_transaction - all writes (terms and relations) share one connection and transaction,
+                         which is ended by commit()
+    """
+    # errors after which the same page can be retried
+    transient_errors = (psycopg2.extensions.TransactionRollbackError, psycopg2.errors.LockNotAvailable)
+
+    def __init__(self, page_size=1000, min_page_size=100, max_page_size=10000, target_latency=1.0,
+                 max_retries=3, single_transaction=False):
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.single_transaction = single_transaction
+        self.con = None  # connection of the single transaction
+        self.failed = False  # the single transaction was rolled back
+        self.logger = logging.getLogger(__name__)
+
+    def adapt_page_size(self, elapsed, rows):
+        """
+        scales the page size towards target_latency, moving half way to avoid oscillation
+        """
+        if rows < self.page_size or elapsed <= 0:
+            return  # short (last) page tells nothing about the right page size
+        scaled = int(self.page_size * self.target_latency / elapsed)
+        self.page_size = max(self.min_page_size, min(self.max_page_size, (self.page_size + scaled) // 2))
+
+    def write(self, cur, execute, rows):
+        """
+        execute(cur, page) - executes the statement for a page(list) of rows
+        returns number of rows skipped because of errors
+        """
+        skipped = 0
+        i = 0
+        while i < len(rows):
+            page = rows[i:i + self.page_size]
+            skipped += self.write_page(cur, execute, page)
+            i += len(page)
+        return skipped
+
+    def write_page(self, cur, execute, page, attempt=0):
+        cur.execute('SAVEPOINT write_page')
+        start = time.monotonic()
+        try:
+            execute(cur, page)
+        except self.transient_errors as error:
+            self.rollback_page(cur)
+            if attempt >= self.max_retries:
+                raise
+            self.logger.warning('Transient error, retrying page of %s rows: %s' % (len(page), error))
+            time.sleep(0.1 * 2 ** attempt)
+            return self.write_page(cur, execute, page, attempt + 1)
+        except psycopg2.errors.QueryCanceled as error:
+            # statement timeout - the page is too large
+            self.rollback_page(cur)
+            if len(page) == 1:
+                raise
+            self.logger.warning('Statement canceled, splitting page of %s rows: %s' % (len(page), error))
+            self.page_size = max(self.min_page_size, len(page) // 2)
+            return self.split_page(cur, execute, page)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as error:
+            # bad data - isolate the bad rows, other errors (schema, SQL, connection) end the transaction
+            self.rollback_page(cur)
+            if len(page) == 1:
+                self.logger.warning('Row skipped: %s %s' % (page[0], error))
+                return 1
+            return self.split_page(cur, execute, page)
+        cur.execute('RELEASE SAVEPOINT write_page')
+        self.adapt_page_size(time.monotonic() - start, len(page))
+        return 0
+
+    def rollback_page(self, cur):
+        """
+        rolls back the page and releases its savepoint (ROLLBACK TO keeps it),
+        so that retries and splits do not leave open savepoints until commit
+        """
+        cur.execute('ROLLBACK TO SAVEPOINT write_page')
+        cur.execute('RELEASE SAVEPOINT write_page')
+
+    def split_page(self, cur, execute, page):
+        half = len(page) // 2
+        return self.write_page(cur, execute, page[:half]) + self.write_page(cur, execute, page[half:])
+
+    def get_connection(self, connector):
+        """
+        connection of the single transaction or a new connection from the connector
+        """
+        if not self.single_transaction:
+            return connector.create_db_connection()
+        if self.con is None:
+            self.con = connector.create_db_connection()
+            self.con.autocommit = False
+        return self.con
+
+    def release_connection(self, con):
+        """
+        closes the connection unless it belongs to the single transaction
+        """
+        if con is not None and con is not self.con:
+            con.close()
+
+    def end_transaction(self, con, success):
+        """
+        commits/rolls back the transaction of a writer,
+        in single_transaction mode only a failure ends (rolls back) the transaction
+        """
+        if con is self.con:
+            if not success:
+                self.failed = True
+                self.rollback()
+            return
+        try:
+            if success:
+                con.commit()
+            else:
+                con.rollback()
+        finally:
+            con.close()
+
+    def rollback(self):
+        if self.con is not None:
+            try:
+                self.con.rollback()
+                self.con.close()
+            except psycopg2.Error as error:
+                self.logger.debug(error)
+            self.con = None
+
+    def commit(self):
+        """
+        ends the single transaction
+        returns False if it was rolled back (always True if not in single_transaction mode)
+        """
+        success = not self.failed
+        if self.con is not None:
+            try:
+                self.con.commit()
+                self.logger.debug('Transaction committed')
+            except psycopg2.DatabaseError as error:
+                self.logger.warning('Failed to commit transaction: %s' % error)
+                success = False
+            self.con.close()
+            self.con = None
+        self.failed = False
+        return success
+
 
 class SQLConnector(object):
     # functions creating connection to the Database
-    def __init__(self,db_cred):
+    def __init__(self,db_cred,write_strategy=None):
         global db_credentials
         db_credentials = db_cred
         self.logger= logging.getLogger(__name__)
+        # writers and readers share the connection of write_strategy in single transaction mode
+        self.write_strategy = write_strategy if write_strategy is not None else WriteStrategy()
 
     def get_engine(self):
         """
@@ -25,8 +188,11 @@ class SQLConnector(object):
         url = 'postgresql://{user}:{passwd}@{host}:{port}/{db}'.format(
             user=db_credentials['user'], passwd=db_credentials['pwd'], host=db_credentials['host'],
             port=db_credentials['port'], db=db_credentials['db'])
-        engine = create_engine(url, pool_size = 50)
-        return engine
+        # the engine is created once, so that connections are reused from its pool
+        # pool_pre_ping - long running processes (daemon mode) survive database restarts
+        if url not in engines:
+            engines[url] = create_engine(url, pool_size = 50, pool_pre_ping = True)
+        return engines[url]
 
     def create_db_connection(self):
         try:
@@ -88,91 +254,102 @@ class SQLExecutor(SQLConnector):
         return semantic_uri
 
 
-    def dataframe_from_database(self,sql_command):
-        con=self.create_db_connection()
-        df=pd.read_sql(sql_command,con)
-        if con is not None:
-                con.close()
+    def get_max_id_term(self):
+        con = self.write_strategy.get_connection(self)
+        cursor = con.cursor()
+        sql_command = 'SELECT MAX(id_term) FROM public.term'
+        try:
+            cursor.execute(sql_command)
+            max_id_term = int(cursor.fetchall()[0][0])
+        except psycopg2.DatabaseError as error:
+            self.logger.debug(error)
+            raise
+        finally:
+            if con is not None:
+                cursor.close()
+                self.write_strategy.release_connection(con)
+
+        return max_id_term
+
+
+    def dataframe_from_database(self,sql_command,params=None):
+        con=self.write_strategy.get_connection(self)
+        df=pd.read_sql(sql_command,con,params=params)
+        self.write_strategy.release_connection(con)
         return df
 
 
-    def batch_insert_new_terms(self,table,df):
+    def write_rows(self,execute,rows,action):
+        """
+        writes rows page by page using write_strategy
+        execute(cur, page) - executes the statement for a page of rows
+        action - description of the write for the log
+        returns False if the transaction was rolled back or some rows were skipped
+        """
+        if self.write_strategy.failed:
+            self.logger.warning('{} skipped, the transaction was rolled back'.format(action))
+            return False
+        if len(rows) == 0:
+            return True
+        conn_pg = self.write_strategy.get_connection(self)
+        conn_pg.autocommit = False
+        cur = conn_pg.cursor()
         try:
-            conn_pg=self.create_db_connection()
-            conn_pg.autocommit = False
-            list_of_tuples = [tuple(x) for x in df.values]
-            df_columns = list(df)      # names of columns 
-            columns = ",".join(df_columns)
-            # create VALUES('%s', '%s",...) one '%s' per column
-            values = "VALUES({})".format(",".join(["%s" for _ in df_columns]))
-            # create INSERT INTO table (columns) VALUES('%s',...)
-            insert_stmt = "INSERT INTO {} ({}) {}".format(table, columns, values)
-            cur = conn_pg.cursor()
-            psycopg2.extras.execute_batch(cur, insert_stmt, list_of_tuples)
-            self.logger.debug("batch_insert_new_terms - record inserted successfully ")
-            # Commit your changes
-            conn_pg.commit()
+            skipped = self.write_strategy.write(cur, execute, rows)
         except psycopg2.DatabaseError as error:
-            self.logger.debug('Failed to insert records to database rollback: %s' % (error))
-            conn_pg.rollback()
-        finally:
-            if conn_pg is not None:
-                cur.close()
-                conn_pg.close()
+            self.logger.warning('{} failed, rollback: {}'.format(action, error))
+            cur.close()
+            self.write_strategy.end_transaction(conn_pg, success=False)
+            return False
+        cur.close()
+        self.write_strategy.end_transaction(conn_pg, success=True)
+        if skipped:
+            self.logger.warning('{} - {} rows skipped'.format(action, skipped))
+            return False
+        self.logger.debug('{} - {} rows written successfully, page size {}'.format(
+            action, len(rows), self.write_strategy.page_size))
+        return True
+
+
+    def batch_insert_new_terms(self,table,df):
+        list_of_tuples = [tuple(x) for x in df.values]
+        df_columns = list(df)      # names of columns 
+        columns = ",".join(df_columns)
+        # create VALUES('%s', '%s",...) one '%s' per column
+        values = "VALUES({})".format(",".join(["%s" for _ in df_columns]))
+        # create INSERT INTO table (columns) VALUES('%s',...)
+        insert_stmt = "INSERT INTO {} ({}) {}".format(table, columns, values)
+        return self.write_rows(
+            lambda cur, page: psycopg2.extras.execute_batch(cur, insert_stmt, page, page_size=len(page)),
+            list_of_tuples, 'batch_insert_new_terms')
     
         
     def batch_update_terms(self,df,columns_to_update,table,condition='id_term'):
-        try:
-            conn_pg = self.create_db_connection()
-            conn_pg.autocommit = False
-            cur = conn_pg.cursor()
-            df=df[columns_to_update]
-            list_of_tuples = [tuple(x) for x in df.values]
-            values='=%s,'.join(columns_to_update[:-1])
-            update_stmt='UPDATE {table_name} SET {values}=%s where {condition}=%s'.format(
-                    table_name=table,values=values,condition='id_term')
-            psycopg2.extras.execute_batch(cur, update_stmt, list_of_tuples)
-            self.logger.debug("batch_update_terms - record updated successfully ")
-            # Commit your changes
-            conn_pg.commit()
-        except psycopg2.DatabaseError as error:
-            self.logger.warning('Failed to update record to database rollback: %s' % error)
-            conn_pg.rollback()
-        finally:
-            if conn_pg is not None:
-                cur.close()
-                conn_pg.close()
+        df=df[columns_to_update]
+        list_of_tuples = [tuple(x) for x in df.values]
+        values='=%s,'.join(columns_to_update[:-1])
+        update_stmt='UPDATE {table_name} SET {values}=%s where {condition}=%s'.format(
+                table_name=table,values=values,condition='id_term')
+        return self.write_rows(
+            lambda cur, page: psycopg2.extras.execute_batch(cur, update_stmt, page, page_size=len(page)),
+            list_of_tuples, 'batch_update_terms')
                 
 
     def insert_update_relations(self,table,df):
-        try:
-            conn_pg = self.create_db_connection()
-            conn_pg.autocommit = False
-            if len(df) > 0:
-                df_columns = list(df)
-                # create (col1,col2,...)
-                columns = ",".join(df_columns)
-                # create VALUES('%s', '%s",...) one '%s' per column
-                #values = "VALUES({})".format(",".join(["%s" for _ in df_columns]))
-                # create INSERT INTO table (columns) VALUES('%s',...)
-                insert_stmt = "INSERT INTO {} AS t ({}) VALUES %s ".format(table, columns)
-                on_conflict = "ON CONFLICT ON CONSTRAINT term_relation_pkey " \
-                              "DO UPDATE SET id_relation_type = EXCLUDED.id_relation_type , " \
-                              "datetime_updated = EXCLUDED.datetime_updated , id_user_updated = EXCLUDED.id_user_updated " \
-                              "WHERE (t.id_relation_type) IS DISTINCT FROM (EXCLUDED.id_relation_type); "
-                upsert_stmt = insert_stmt + on_conflict
-                cur = conn_pg.cursor()
-                #psycopg2.extras.execute_batch(cur, upsert_stmt, df.values)
-                psycopg2.extras.execute_values(cur, upsert_stmt, df.values,page_size=10000)
-                self.logger.debug("Relations inserted/updated successfully ")
-                conn_pg.commit()
-        except psycopg2.DatabaseError as error:
-                self.logger.warning('Failed to insert/update relations to database rollback:  %s' % error)
-                conn_pg.rollback()
-        finally:
-            if conn_pg is not None:
-                cur.close()
-                conn_pg.close()
+        df_columns = list(df)
+        # create (col1,col2,...)
+        columns = ",".join(df_columns)
+        # create INSERT INTO table (columns) VALUES('%s',...)
+        insert_stmt = "INSERT INTO {} AS t ({}) VALUES %s ".format(table, columns)
+        on_conflict = "ON CONFLICT ON CONSTRAINT term_relation_pkey " \
+                      "DO UPDATE SET id_relation_type = EXCLUDED.id_relation_type , " \
+                      "datetime_updated = EXCLUDED.datetime_updated , id_user_updated = EXCLUDED.id_user_updated " \
+                      "WHERE (t.id_relation_type) IS DISTINCT FROM (EXCLUDED.id_relation_type); "
+        upsert_stmt = insert_stmt + on_conflict
+        list_of_tuples = [tuple(x) for x in df.values]
+        return self.write_rows(
+            lambda cur, page: psycopg2.extras.execute_values(cur, upsert_stmt, page, page_size=len(page)),
+            list_of_tuples, 'insert_update_relations')
 
 
 class DframeManipulator(SQLConnector):
@@ -225,22 +402,24 @@ class DframeManipulator(SQLConnector):
     
     
     # create dataframe to be inserted or updated (from harvested values and default values)
-    def df_shaper(self,df,id_term_category,id_user_created,id_user_updated, df_pang=None):
+    def df_shaper(self,df,id_term_category,id_user_created,id_user_updated, df_pang=None, id_terms=None):
         # Check the last id_term in SQL db
         if df_pang is not None:   # if UPDATE id_terms stay the same
             #uri_list=list(df.semantic_uri)  # list of sematic_uri's of the df_update dataframe
             #mask = df_pang.semantic_uri.apply(lambda x: x in uri_list )   # corresponding id_terms's from df_from_pangea (PANGAEA dataframe to be updated)
             #df=df.assign(id_term=df_pang[mask].id_term.values)
             df = pd.merge(df_pang[['semantic_uri','id_term']], df, on='semantic_uri', how = 'right')
+        elif id_terms is not None: # if INSERT with id_term's already allocated (sharded import)
+            df=df.assign(id_term=id_terms)
         else: # if INSERT generate new id_term's
-            con=self.create_db_connection()
+            con=self.write_strategy.get_connection(self)
             cursor=con.cursor()
             cursor.execute('SELECT MAX(id_term) FROM public.term')
             max_id_term=int(cursor.fetchall()[0][0])
             df=df.assign(id_term=list(range(1+max_id_term,len(df)+max_id_term+1)))
             if con is not None:
                 cursor.close()
-                con.close()
+                self.write_strategy.release_connection(con)
         # assign deafult values to columns
         
         #df=df.assign(abbreviation="")
@@ -292,24 +471,37 @@ class DframeManipulator(SQLConnector):
         return df_rs
 
     
-    def get_related_semantic_uri(self,df,has_broader_term_pk):
+    def get_related_semantic_uri(self,df,has_broader_term_pk,df_lookup=None):
         '''
         INPUT - df=df_from_nerc - dataframe read from xml containing related_uri column
+                - df_lookup - optional dataframe (uri, semantic_uri) e.g. from public.term, used to resolve
+                  related uri's of terms not in df (delta harvest)
         OUTPUT - dataframe containing semantic_uri corresponding to the uri's in the INPUT file
+        Related uri's which cannot be resolved are dropped together with their relation type
         '''
+        # uri -> semantic_uri, the first occurrence wins (terms of df before df_lookup)
+        s_uri_by_uri=dict()
+        lookups=[df] if df_lookup is None else [df,df_lookup]
+        for df_uris in lookups:
+            for uri,s_uri in zip(df_uris.uri,df_uris.semantic_uri):
+                s_uri_by_uri.setdefault(uri,s_uri)
         related_s_uri=list()
-        for related_uri_list in df.related_uri:
+        related_types=list()
+        for related_uri_list,type_list in zip(df.related_uri,df.id_relation_type):
             templist=list()
-            for related_uri in related_uri_list:
-                current_list=df.loc[df.uri==related_uri,'semantic_uri']
-                if len(current_list)!=0:
-                    templist.append(current_list.values[0])
+            typelist=list()
+            for related_uri,id_relation_type in zip(related_uri_list,type_list):
+                if related_uri in s_uri_by_uri:
+                    templist.append(s_uri_by_uri[related_uri])
+                    typelist.append(id_relation_type)
             
             related_s_uri.append(templist)
-        df=df.assign(related_s_uri=related_s_uri)
+            related_types.append(typelist)
 
-        # select orphans - elements without 'broader' relation to any other element
+        # select orphans - elements without 'broader' relation to any other element (as read from xml)
         orphan=[df.id_relation_type.apply(lambda x:1 not in x)][0]
+        # new lists, so that the relation types of the INPUT dataframe are not modified
+        df=df.assign(related_s_uri=related_s_uri,id_relation_type=related_types)
         subroot_semantic_uris=list(set(df['subroot_semantic_uri']))
         if True in set(orphan):    # if there are some orphan elements
             # select an 'orphan' subset of df
@@ -337,29 +529,40 @@ class DframeManipulator(SQLConnector):
         INPUT - df_related dataframe with column of semantic_uri and 2nd column of related semantic uri
                 - df_pang dataframe from public.term table, containing all 17 columns
         OUTPUT - dataframe with 2 additional columns - id_term's corresponding to the 2 columns in INPUT dataframe
+        Terms not found in df_pang (e.g. rows skipped by the writers) are dropped with a warning,
+        so that relations are written for the terms that exist
         '''
+        # take corresponding id_terms from SQL pangaea_db.term table
+        id_terms=dict(zip(df_pang.semantic_uri,df_pang.id_term))
         id_term_list=list()
-        for s_uri in list(df_related.semantic_uri):
-            # take corresponding id_terms from SQL pangaea_db.term table
-            values_to_append=df_pang.loc[df_pang.semantic_uri == s_uri, 'id_term'].values
-            if len(values_to_append)!=0:
-                id_term_list.append(values_to_append[0])
-            else:
-                self.logger.debug('Warning! Could not get_primary_key for {} semantic_uri'.format(s_uri))
-        try:
-            df_related=df_related.assign(id_term=id_term_list) # create id_term column conatining id_terms form df_pang corresponding to semantic_uri from df_related
-        except ValueError as e:
-            self.logger.debug(e)
-            raise
-            
         related_id_terms=list()
-        #create a column id_term_related 
-        for s_uri_list in df_related.related_s_uri:
+        id_relation_types=list()
+        mask=list()
+        for s_uri,s_uri_list,type_list in zip(df_related.semantic_uri,df_related.related_s_uri,
+                                              df_related.id_relation_type):
+            if s_uri not in id_terms:
+                self.logger.warning('Could not get_primary_key for {} semantic_uri, relations skipped'.format(s_uri))
+                mask.append(False)
+                continue
+            # get_related_semantic_uri drops the relation types of unresolved uri's together with them
+            assert len(s_uri_list)==len(type_list), \
+                'related terms and relation types of {} are not aligned'.format(s_uri)
             templist=list()
-            for s_uri in s_uri_list:
-                templist.append(df_pang.loc[df_pang.semantic_uri==s_uri,'id_term'].values[0])
+            typelist=list()
+            for related_s_uri,id_relation_type in zip(s_uri_list,type_list):
+                if related_s_uri in id_terms:
+                    templist.append(id_terms[related_s_uri])
+                    typelist.append(id_relation_type)
+                else:
+                    self.logger.warning('Could not get_primary_key for {} semantic_uri, relation of {} skipped'
+                                        .format(related_s_uri,s_uri))
+            mask.append(True)
+            id_term_list.append(id_terms[s_uri])
             related_id_terms.append(templist)
-        df_related['related_terms']=related_id_terms
+            id_relation_types.append(typelist)
+        df_related=df_related[mask]
+        df_related=df_related.assign(id_term=id_term_list,related_terms=related_id_terms,
+                                     id_relation_type=id_relation_types)
         
         return df_related
     